@@ -2,6 +2,7 @@ from oai_agents.agents.base_agent import *
 from oai_agents.agents.il import *
 from oai_agents.agents.rl import *
 from oai_agents.agents.hrl import *
+from oai_agents.agents.base_agent import _TH_SAVE_KWARGS
 from oai_agents.common.arguments import get_arguments
 from pathlib import Path
 import torch as th
@@ -14,7 +15,7 @@ def fix_save_pickle(agent_path, args=None):
     agent_path = Path(agent_path)
 
     try:
-        load_dict = th.load(agent_path / 'agent_file')
+        load_dict = th.load(agent_path / 'agent_file', weights_only=False)
         print(load_dict)
     except FileNotFoundError as e:
         raise ValueError(f'Could not find file:{e}') # TODO print options
@@ -34,7 +35,7 @@ def fix_save_pickle(agent_path, args=None):
         save_dict[k] = v
     print(load_dict)
     print(save_dict)
-    th.save(save_dict, agent_path / 'agent_file_fixed')
+    th.save(save_dict, agent_path / 'agent_file_fixed', **_TH_SAVE_KWARGS)
 
 
 
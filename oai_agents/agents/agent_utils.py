@@ -13,7 +13,7 @@ def load_agent(agent_path, args=None):
     args = args or get_arguments()
     agent_path = Path(agent_path)
     try:
-        load_dict = th.load(agent_path / 'agent_file')
+        load_dict = th.load(agent_path / 'agent_file', map_location='cpu', mmap=True, weights_only=False)
     except FileNotFoundError as e:
         raise ValueError(f'Could not find file:{e}')  # TODO print options
     agent = load_dict['agent_type'].load(agent_path, args)
@@ -32,6 +32,8 @@ class DummyPolicy:
         self.observation_space = obs_space
 
 class DummyAgent:
+    supports_batched_episodes = True
+
     def __init__(self, action=Action.STAY):
         self.action = action if 'random' in action else Action.ACTION_TO_INDEX[action]
         self.name = f'{action}_agent'
@@ -16,10 +16,53 @@ import torch as th
 import torch.nn as nn
 from typing import List, Tuple, Union
 import stable_baselines3.common.distributions as sb3_distributions
-from stable_baselines3.common.evaluation import evaluate_policy
+from stable_baselines3.common.vec_env import DummyVecEnv, VecEnv
 from stable_baselines3.common.vec_env.stacked_observations import StackedObservations
 import wandb
 
+VEC_ENV_CLS = DummyVecEnv #SubprocVecEnv
+# Evaluation env pools share objects (agents, planner, window, ...) between their envs, which only works in process.
+# They must stay a DummyVecEnv, whatever the training envs use
+EVAL_VEC_ENV_CLS = DummyVecEnv
+# Checkpoints are saved in the zipfile format, which is required to load them with mmap=True, and with pickle
+# protocol 5, which pickles large buffers faster
+_TH_SAVE_KWARGS = dict(_use_new_zipfile_serialization=True, pickle_protocol=5)
+# Side cuda stream used to copy loaded checkpoints to the gpu, created on first use
+_load_stream = None
+
+
+def _state_dict_to_device(state_dict, device):
+    """
+    Moves a cpu state dict to device (in place). On cuda, each tensor is staged in pinned memory and copied
+    asynchronously on a side stream, so that reading a tensor from disk overlaps with the copy of the previous one.
+    """
+    global _load_stream
+    if th.device(device).type != 'cuda':
+        return state_dict
+    if _load_stream is None:
+        _load_stream = th.cuda.Stream()
+    with th.cuda.stream(_load_stream):
+        for k, v in state_dict.items():
+            state_dict[k] = v.pin_memory().to(device, non_blocking=True)
+    _load_stream.synchronize()
+    # Tensors were allocated on the side stream, make sure their memory isn't reused while the default stream uses them
+    for v in state_dict.values():
+        v.record_stream(th.cuda.current_stream())
+    return state_dict
+
+
+def jit_script_mlps(module: nn.Module):
+    """
+    Recursively replaces the nn.Sequential submodules of module with their TorchScript version.
+    Sequentials with hooks (e.g. spectral norm) are skipped since scripting would drop the hooks.
+    Scripted modules share their parameters with the original ones, so they can still be trained.
+    """
+    for name, child in module.named_children():
+        if isinstance(child, nn.Sequential) and len(child) > 0 and \
+                not any(m._forward_pre_hooks or m._forward_hooks for m in child.modules()):
+            setattr(module, name, th.jit.script(child))
+        else:
+            jit_script_mlps(child)
 
 class OAIAgent(nn.Module, ABC):
     """
@@ -27,6 +70,9 @@ class OAIAgent(nn.Module, ABC):
     https://stable-baselines3.readthedocs.io/en/master/modules/base.html#stable_baselines3.common.base_class.BaseAlgorithm
     Ensures that all agents play nicely with the environment
     """
+    # True if the agent keeps no per-episode state, so that a single instance can play several episodes in lock-step
+    # (e.g. in OAITrainer.evaluate's env pools). Must be set explicitly by subclasses that don't keep state
+    supports_batched_episodes = False
 
     def __init__(self, name, args):
         super(OAIAgent, self).__init__()
@@ -42,6 +88,10 @@ class OAIAgent(nn.Module, ABC):
         self.horizon = None
         self.prev_st = Subtasks.SUBTASKS_TO_IDS['unknown']
         self.use_hrl_obs = False
+        # Args saved by older versions may not have this set
+        self.compile_model = getattr(args, 'compile_model', False)
+        # If True, predict accepts observations as torch tensors on args.device, letting action() skip numpy inputs
+        self.tensor_obs = False
 
     @abstractmethod
     def predict(self, obs: th.Tensor, state=None, episode_start=None, deterministic: bool = False) -> Tuple[
@@ -121,6 +171,9 @@ class OAIAgent(nn.Module, ABC):
 
         self.prev_state = deepcopy(state)
         obs = {k: v for k, v in obs.items() if k in self.policy.observation_space.keys()}
+        if self.tensor_obs:
+            obs = {k: th.as_tensor(np.ascontiguousarray(v)).to(self.args.device, non_blocking=True)
+                   for k, v in obs.items()}
 
         try:
             agent_msg = self.get_agent_output()
@@ -149,7 +202,7 @@ class OAIAgent(nn.Module, ABC):
         save_path = path / 'agent_file'
         args = get_args_to_save(self.args)
         th.save({'agent_type': type(self), 'state_dict': self.state_dict(),
-                 'const_params': self._get_constructor_parameters(), 'args': args}, save_path)
+                 'const_params': self._get_constructor_parameters(), 'args': args}, save_path, **_TH_SAVE_KWARGS)
 
     @classmethod
     def load(cls, path: str, args: argparse.Namespace) -> 'OAIAgent':
@@ -161,31 +214,72 @@ class OAIAgent(nn.Module, ABC):
         """
         device = args.device
         load_path = path / 'agent_file'
-        saved_variables = th.load(load_path, map_location=device)
+        # mmap avoids reading the whole checkpoint into memory before moving it to device. Mapped tensors are only read
+        # while loading, never kept by the model. Weights are moved to device by _state_dict_to_device to overlap disk
+        # reads with host to device copies
+        saved_variables = th.load(load_path, map_location='cpu', mmap=True, weights_only=False)
         set_args_from_load(saved_variables['args'], args)
         saved_variables['const_params']['args'] = args
-        # Create agent object
-        model = cls(**saved_variables['const_params'])  # pytype: disable=not-instantiable
-        # Load weights
-        model.load_state_dict(saved_variables['state_dict'])
+        # Create agent object directly on the target device, skipping initialization on cpu and the copy to device.
+        # Not the meta device, since agent constructors (e.g. BehaviouralCloningAgent) move themselves to args.device
+        with th.device(device):
+            model = cls(**saved_variables['const_params'])  # pytype: disable=not-instantiable
+        # Load weights. They are copied into the model's own tensors: with assign=True, parameters loaded on cpu would
+        # stay memory mapped on the checkpoint file, which breaks as soon as that file is overwritten (e.g. save_agents)
+        state_dict = _state_dict_to_device(saved_variables['state_dict'], device)
+        model.load_state_dict(state_dict, strict=True)
         model.to(device)
         return model
 
 
 class SB3Wrapper(OAIAgent):
+    supports_batched_episodes = True
+
     def __init__(self, agent, name, args):
         super(SB3Wrapper, self).__init__(name, args)
         self.agent = agent
         self.policy = self.agent.policy
+        # Compiled copy of the policy's forward pass, only used by predict. The policy itself is left as is since it is
+        # also used for training (e.g. PPO's collect_rollouts and train)
+        self.compiled_forward = None
+        if self.compile_model:
+            self.compiled_forward = th.compile(self.policy.forward, mode='reduce-overhead', dynamic=False)
+        elif getattr(args, 'jit_policy', False):
+            jit_script_mlps(self.policy)
+        self.tensor_obs = True
         self.num_timesteps = 0
 
+    def _obs_to_tensor(self, obs):
+        """
+        Same as the policy's obs_to_tensor, but observations that are already torch tensors are used as is instead of
+        going through numpy
+        """
+        if not all(isinstance(v, th.Tensor) for v in obs.values()):
+            return self.policy.obs_to_tensor(obs)
+        obs_space = self.policy.observation_space
+        vectorized_env = any(v.dim() > len(obs_space[k].shape) for k, v in obs.items())
+        obs = {k: v.to(self.policy.device).reshape((-1,) + obs_space[k].shape) for k, v in obs.items()}
+        return obs, vectorized_env
+
+    @th.inference_mode()
     def predict(self, obs, state=None, episode_start=None, deterministic=False):
         # Based on https://github.com/DLR-RM/stable-baselines3/blob/master/stable_baselines3/common/policies.py#L305
         # Updated to include action masking
         self.policy.set_training_mode(False)
-        obs, vectorized_env = self.policy.obs_to_tensor(obs)
-        with th.no_grad():
-            if 'subtask_mask' in obs and np.prod(obs['subtask_mask'].shape) == np.prod(self.agent.action_space.n):
+        if self.compiled_forward is not None:
+            # The compiled forward pass is specialized to static shapes, any other shape would trigger a recompile
+            obs_space = self.policy.observation_space
+            assert all(np.shape(v) == obs_space[k].shape or np.shape(v)[1:] == obs_space[k].shape
+                       for k, v in obs.items()), \
+                'Observation shapes must match the observation space (with an optional batch dimension) when using a ' \
+                'compiled model'
+        obs, vectorized_env = self._obs_to_tensor(obs)
+        use_mask = 'subtask_mask' in obs and obs['subtask_mask'].shape[-1] == self.agent.action_space.n
+        if self.compiled_forward is not None and not use_mask:
+            # Go through the compiled forward pass. Masked distributions are not part of forward, so they can't use it
+            actions = self.compiled_forward(obs, deterministic=deterministic)[0]
+        else:
+            if use_mask:
                 dist = self.policy.get_distribution(obs, obs['subtask_mask'])
             else:
                 dist = self.policy.get_distribution(obs)
@@ -198,14 +292,14 @@ class SB3Wrapper(OAIAgent):
             actions = actions.squeeze(axis=0)
         return actions, state
 
+    @th.inference_mode()
     def get_distribution(self, obs: th.Tensor):
         self.policy.set_training_mode(False)
-        obs, vectorized_env = self.policy.obs_to_tensor(obs)
-        with th.no_grad():
-            if 'subtask_mask' in obs and np.prod(obs['subtask_mask'].shape) == np.prod(self.policy.action_space.n):
-                dist = self.policy.get_distribution(obs, obs['subtask_mask'])
-            else:
-                dist = self.policy.get_distribution(obs)
+        obs, vectorized_env = self._obs_to_tensor(obs)
+        if 'subtask_mask' in obs and obs['subtask_mask'].shape[-1] == self.policy.action_space.n:
+            dist = self.policy.get_distribution(obs, obs['subtask_mask'])
+        else:
+            dist = self.policy.get_distribution(obs)
         return dist
 
     def learn(self, total_timesteps):
@@ -221,7 +315,7 @@ class SB3Wrapper(OAIAgent):
         save_path = path / 'agent_file'
         args = get_args_to_save(self.args)
         th.save({'agent_type': type(self), 'sb3_model_type': type(self.agent),
-                 'const_params': self._get_constructor_parameters(), 'args': args}, save_path)
+                 'const_params': self._get_constructor_parameters(), 'args': args}, save_path, **_TH_SAVE_KWARGS)
         self.agent.save(str(save_path) + '_sb3_agent')
 
     @classmethod
@@ -234,11 +328,13 @@ class SB3Wrapper(OAIAgent):
         """
         device = args.device
         load_path = path / 'agent_file'
-        saved_variables = th.load(load_path)
+        saved_variables = th.load(load_path, map_location=device, mmap=True, weights_only=False)
         set_args_from_load(saved_variables['args'], args)
         saved_variables['const_params']['args'] = args
-        # Create agent object
-        agent = saved_variables['sb3_model_type'].load(str(load_path) + '_sb3_agent')
+        # Create agent object. Weights are not staged through _state_dict_to_device here: stable baselines' load also
+        # restores the optimizer state and builds the rollout buffer on the device it is given, so the policy has to be
+        # loaded by it directly on device
+        agent = saved_variables['sb3_model_type'].load(str(load_path) + '_sb3_agent', device=device)
         # Create wrapper object
         model = cls(agent=agent, **saved_variables['const_params'], **kwargs)  # pytype: disable=not-instantiable
         model.to(device)
@@ -247,12 +343,18 @@ class SB3Wrapper(OAIAgent):
 
 class SB3LSTMWrapper(SB3Wrapper):
     ''' A wrapper for a stable baselines 3 agents that uses an lstm and controls a single player '''
+    # Keeps the lstm states of the current episode
+    supports_batched_episodes = False
+
     def __init__(self, agent, name, args):
         super(SB3LSTMWrapper, self).__init__(agent, name, args)
+        # Recurrent predict goes through stable baselines, which only takes numpy observations
+        self.tensor_obs = False
         self.lstm_states = None
 
+    @th.inference_mode()
     def predict(self, obs, state=None, episode_start=None, deterministic=False):
-        episode_start = episode_start or np.ones((1,), dtype=bool)
+        episode_start = episode_start if episode_start is not None else np.ones((1,), dtype=bool)
         action, self.lstm_states = self.agent.predict(obs, state=state, episode_start=episode_start,
                                                       deterministic=deterministic)
         return action, self.lstm_states
@@ -267,6 +369,8 @@ class PolicyClone(OAIAgent):
     Policy Clones are copies of other agents policies (and nothing else). They can only play the game.
     They do not support training, saving, or loading, just playing.
     """
+    supports_batched_episodes = True
+
     def __init__(self, source_agent, args, device=None):
         """
         Given a source agent, create a new agent that plays identically.
@@ -329,6 +433,40 @@ class PolicyClone(OAIAgent):
     def load(self, path, args):
         raise NotImplementedError('Loading is not supported for cloned policies')
 
+def _batched_eval(env: VecEnv, agent, n_episodes, deterministic=False, render=False) -> Tuple[float, float]:
+    """
+    Plays n_episodes spread over all the envs of env, querying the agent once per step with the observations of every
+    env stacked together. Based on stable baselines' evaluate_policy.
+    :return: mean and standard deviation of the episode returns
+    """
+    n_envs = env.num_envs
+    # Split episodes evenly between envs so that the result isn't biased towards shorter episodes
+    episode_targets = np.array([(n_episodes + i) // n_envs for i in range(n_envs)])
+    episode_counts = np.zeros(n_envs, dtype=int)
+    current_returns = np.zeros(n_envs)
+    episode_returns = []
+    obs = env.reset()
+    states, episode_starts = None, np.ones((n_envs,), dtype=bool)
+    while (episode_counts < episode_targets).any():
+        if agent.tensor_obs:
+            obs = {k: th.as_tensor(v, device=agent.args.device) for k, v in obs.items()}
+        actions, states = agent.predict(obs, state=states, episode_start=episode_starts, deterministic=deterministic)
+        if isinstance(actions, th.Tensor):
+            actions = actions.cpu().numpy()
+        env.step_async(actions)
+        obs, rewards, dones, infos = env.step_wait()
+        current_returns += rewards
+        for i in np.flatnonzero(dones):
+            if episode_counts[i] < episode_targets[i]:
+                episode_returns.append(current_returns[i])
+                episode_counts[i] += 1
+            current_returns[i] = 0
+        episode_starts = dones
+        if render:
+            env.env_method('render', indices=0)
+    return np.mean(episode_returns), np.std(episode_returns)
+
+
 class OAITrainer(ABC):
     """
     An abstract base class for trainer classes.
@@ -344,6 +482,8 @@ class OAITrainer(ABC):
             np.random.seed(seed)
 
         self.eval_teammates = None
+        # Vectorized copies of the evaluation environments, see get_eval_env_pool
+        self.eval_env_pools = {}
 
         # For environment splits while training
         self.n_layouts = len(self.args.layout_names)
@@ -369,6 +509,23 @@ class OAITrainer(ABC):
             return lr
         return linear_anneal
 
+    def get_eval_env_pool(self, env, n_envs):
+        '''
+        Returns a vectorized env made of n_envs copies of env, so that the evaluated agent is queried once per step for
+        n_envs episodes. The envs are stepped one after the other, in this process: the speedup comes from batching the
+        agent's queries, not from stepping envs in parallel. Pools are created once and reused.
+        NOTE: All copies share the same agents (teammate, worker, ...), so n_envs > 1 must only be used with stateless
+        agents, see OAIAgent.supports_batched_episodes.
+        '''
+        if (env, n_envs) not in self.eval_env_pools:
+            # Agents, the layout, the planner, args and the visualization window are shared by the copies instead of
+            # being copied. The window can't be copied, and the rest is read only and expensive to copy
+            shared_attrs = ['mdp', 'mlam', 'terrain', 'args', 'window']
+            memo = {id(v): v for k, v in vars(env).items() if isinstance(v, nn.Module) or k in shared_attrs}
+            env_fns = [lambda: deepcopy(env, dict(memo)) for _ in range(n_envs)]
+            self.eval_env_pools[(env, n_envs)] = EVAL_VEC_ENV_CLS(env_fns)
+        return self.eval_env_pools[(env, n_envs)]
+
     def evaluate(self, eval_agent, num_eps_per_layout_per_tm=4, visualize=False, timestep=None, log_wandb=True,
                  deterministic=False):
         tot_mean_reward = []
@@ -378,9 +535,14 @@ class OAITrainer(ABC):
             tms = self.eval_teammates[env.get_layout_name()] if use_layout_specific_tms else self.eval_teammates
             mean_reward_for_layout = []
             for tm in tms:
-                env.set_teammate(tm)
-                mean_reward, std_reward = evaluate_policy(eval_agent, env, n_eval_episodes=num_eps_per_layout_per_tm,
-                                                          deterministic=deterministic, warn=False, render=visualize)
+                # The pool's envs all share the evaluated agent and the teammate, so episodes with a stateful agent are
+                # played one at a time
+                batch = eval_agent.supports_batched_episodes and tm.supports_batched_episodes
+                n_envs = num_eps_per_layout_per_tm if batch else 1
+                env_pool = self.get_eval_env_pool(env, n_envs)
+                env_pool.env_method('set_teammate', tm)
+                mean_reward, std_reward = _batched_eval(env_pool, eval_agent, num_eps_per_layout_per_tm,
+                                                        deterministic=deterministic, render=visualize)
                 tot_mean_reward.append(mean_reward)
                 mean_reward_for_layout.append(mean_reward)
                 print(f'Eval at timestep {timestep} for layout {env.layout_name} with tm {tm.name}: {mean_reward}')
@@ -393,15 +555,20 @@ class OAITrainer(ABC):
         return np.mean(tot_mean_reward)
 
     def set_new_teammates(self):
-        for i in range(self.args.n_envs):
-            # each layout has different potential teammates
-            if type(self.teammates) == dict:
-                layout_name = self.env.env_method('get_layout_name', indices=i)[0]
-                teammates = self.teammates[layout_name]
-            else: # all layouts share teammates
-                teammates = self.teammates
-            teammate = teammates[np.random.randint(len(teammates))]
-            self.env.env_method('set_teammate', teammate, indices=i)
+        # each layout has different potential teammates
+        if type(self.teammates) == dict:
+            layout_names = self.env.env_method('get_layout_name')
+            teammates_per_env = [self.teammates[layout_name] for layout_name in layout_names]
+        else: # all layouts share teammates
+            teammates_per_env = [self.teammates] * self.args.n_envs
+        tm_idxs = np.random.randint([len(teammates) for teammates in teammates_per_env])
+        # Group envs by selected teammate so that each teammate is only sent once to the envs that use it
+        envs_per_teammate = {}
+        for i, (teammates, tm_idx) in enumerate(zip(teammates_per_env, tm_idxs)):
+            teammate = teammates[tm_idx]
+            envs_per_teammate.setdefault(id(teammate), (teammate, []))[1].append(i)
+        for teammate, indices in envs_per_teammate.values():
+            self.env.env_method('set_teammate', teammate, indices=indices)
 
     def set_new_envs(self):
         if self.args.multi_env_mode == 'splits':
@@ -438,12 +605,15 @@ class OAITrainer(ABC):
         save_path = path / tag / 'trainer_file'
         agent_path = path / tag / 'agents_dir'
         Path(agent_path).mkdir(parents=True, exist_ok=True)
-        save_dict = {'agent_fns': []}
+        # Agent types are stored here so that loading doesn't need to open every agent file twice. Args are restored from
+        # each agent's own file by its load
+        save_dict = {'agent_fns': [], 'agent_types': []}
         for i, agent in enumerate(self.agents):
             agent_path_i = agent_path / f'agent_{i}'
             agent.save(agent_path_i)
             save_dict['agent_fns'].append(f'agent_{i}')
-        th.save(save_dict, save_path)
+            save_dict['agent_types'].append(type(agent))
+        th.save(save_dict, save_path, **_TH_SAVE_KWARGS)
         return path, tag
 
     def load_agents(self, path: Union[Path, None] = None, tag: Union[str, None] = None):
@@ -453,13 +623,19 @@ class OAITrainer(ABC):
         load_path = path / tag / 'trainer_file'
         agent_path = path / tag / 'agents_dir'
         device = self.args.device
-        saved_variables = th.load(load_path, map_location=device)
+        saved_variables = th.load(load_path, map_location=device, mmap=True, weights_only=False)
 
         # Load weights
         agents = []
-        for agent_fn in saved_variables['agent_fns']:
-            agent = load_agent(agent_path / agent_fn, self.args)
-            agent.to(device)
-            agents.append(agent)
+        if 'agent_types' in saved_variables:
+            for agent_fn, agent_type in zip(saved_variables['agent_fns'], saved_variables['agent_types']):
+                agent = agent_type.load(agent_path / agent_fn, self.args)
+                agent.to(device)
+                agents.append(agent)
+        else: # Trainer files saved before agent types were stored
+            for agent_fn in saved_variables['agent_fns']:
+                agent = load_agent(agent_path / agent_fn, self.args)
+                agent.to(device)
+                agents.append(agent)
         self.agents = agents
         return self.agents
@@ -1,4 +1,4 @@
-from oai_agents.agents.base_agent import OAIAgent
+from oai_agents.agents.base_agent import OAIAgent, _TH_SAVE_KWARGS
 from oai_agents.agents.il import BehavioralCloningTrainer
 from oai_agents.agents.rl import MultipleAgentsTrainer, SingleAgentTrainer, SB3Wrapper, SB3LSTMWrapper, VEC_ENV_CLS
 from oai_agents.agents.agent_utils import DummyAgent, is_held_obj, load_agent
@@ -70,14 +70,14 @@ class MultiAgentSubtaskWorker(OAIAgent):
             agent_path_i = agent_dir / f'subtask_{i}_agent'
             agent.save(agent_path_i)
             save_dict['agent_fns'].append(f'subtask_{i}_agent')
-        th.save(save_dict, save_path)
+        th.save(save_dict, save_path, **_TH_SAVE_KWARGS)
 
     @classmethod
     def load(cls, path: Path, args):
         device = args.device
         load_path = path / 'agent_file'
         agent_dir = path / 'subtask_agents_dir'
-        saved_variables = th.load(load_path, map_location=device)
+        saved_variables = th.load(load_path, map_location=device, mmap=True, weights_only=False)
         set_args_from_load(saved_variables['args'], args)
         saved_variables['const_params']['args'] = args
 
@@ -359,7 +359,8 @@ class HierarchicalRL(OAIAgent):
         self.manager.save(manager_save_path)
         args = get_args_to_save(self.args)
         th.save({'worker_type': type(self.worker), 'manager_type': type(self.manager),
-                 'agent_type': type(self), 'const_params': self._get_constructor_parameters(), 'args': args}, save_path)
+                 'agent_type': type(self), 'const_params': self._get_constructor_parameters(), 'args': args}, save_path,
+                **_TH_SAVE_KWARGS)
 
     @classmethod
     def load(cls, path: Path, args) -> 'OAIAgent':
@@ -371,7 +372,7 @@ class HierarchicalRL(OAIAgent):
         """
         device = args.device
         load_path = path / 'agent_file'
-        saved_variables = th.load(load_path, map_location=device)
+        saved_variables = th.load(load_path, map_location=device, mmap=True, weights_only=False)
         set_args_from_load(saved_variables['args'], args)
         worker = saved_variables['worker_type'].load(path / 'worker', args)
         manager = saved_variables['manager_type'].load(path / 'manager', args)
@@ -41,6 +41,10 @@ def get_arguments(additional_args=[]):
                         help='Wandb mode. One of ["online", "offline", "disabled"')
     parser.add_argument('--wandb-ent', type=str, default='stephaneao',
                         help='Wandb entity to log to.')
+    parser.add_argument('--compile-model', action='store_true',
+                        help='Compile agent policies with torch.compile to speed up per-step inference.')
+    parser.add_argument('--jit-policy', action='store_true',
+                        help='Script the MLPs of stable baselines policies with TorchScript to speed up inference.')
 
     parser.add_argument('-c', type=str, default='', help='for stupid reasons, but dont delete')
     parser.add_argument('args', nargs='?', type=str, default='', help='')
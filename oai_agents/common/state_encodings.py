@@ -88,15 +88,15 @@ def OAI_egocentric_encode_state(mdp: OvercookedGridworld, state: OvercookedState
 
 def get_egocentric_grid(grid: np.array, ego_grid_shape: Tuple[int, int], player: PlayerState) -> np.array:
     assert len(grid.shape) == 3  # (Features, X, Y)
-    # We pad so that we can mask the egocentric view without worrying about out-of-bounds errors
-    x_pad_amount = ego_grid_shape[0] // 2
-    y_pad_amount = ego_grid_shape[1] // 2
-    padding_amount = ((0, 0), (x_pad_amount, x_pad_amount), (y_pad_amount, y_pad_amount))
-    padded_grid = np.pad(grid, padding_amount)
-
-    player_obs = padded_grid[:,
-                             player.position[0]: player.position[0] + 2*x_pad_amount + 1,
-                             player.position[1]: player.position[1] + 2*y_pad_amount + 1]
+    # Copy the part of the grid that is visible from the player's position into an empty egocentric view.
+    # Equivalent to padding the full grid and slicing it, without allocating the padded grid
+    x_start = player.position[0] - ego_grid_shape[0] // 2
+    y_start = player.position[1] - ego_grid_shape[1] // 2
+    x_min, x_max = max(x_start, 0), min(x_start + ego_grid_shape[0], grid.shape[1])
+    y_min, y_max = max(y_start, 0), min(y_start + ego_grid_shape[1], grid.shape[2])
+    player_obs = np.zeros((grid.shape[0], *ego_grid_shape), dtype=grid.dtype)
+    player_obs[:, x_min - x_start: x_max - x_start, y_min - y_start: y_max - y_start] = \
+        grid[:, x_min: x_max, y_min: y_max]
 
     if player.orientation == Direction.SOUTH:
         return player_obs
@@ -170,14 +170,20 @@ class OvercookedGymEnv(Env):
 
         return obs
 
-    def step(self, action):
+    def step(self, action, tm_action=None):
+        '''
+        :param tm_action: The teammate's action, if the caller already computed it from get_obs(t_idx) (e.g. to batch
+                          it with the main agent's prediction). If None, the teammate is queried here.
+        '''
         if self.teammate is None:
             raise ValueError('set_teammate must be set called before starting game.')
 
         joint_action = [None, None]
         joint_action[self.p_idx] = action
-        tm_obs = self.get_obs(p_idx=self.t_idx, enc_fn=self.teammate.encoding_fn)
-        joint_action[self.t_idx] = self.teammate.predict(tm_obs)[0]
+        if tm_action is None:
+            tm_obs = self.get_obs(p_idx=self.t_idx, enc_fn=self.teammate.encoding_fn)
+            tm_action = self.teammate.predict(tm_obs)[0]
+        joint_action[self.t_idx] = tm_action
         joint_action = [Action.INDEX_TO_ACTION[(a.squeeze() if type(a) != int else a)] for a in joint_action]
 
         # If the state didn't change from the previous timestep and the agent is choosing the same action
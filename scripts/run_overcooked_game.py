@@ -1,3 +1,5 @@
+import ast
+from functools import lru_cache
 import json
 import numpy as np
 import pandas as pd
@@ -5,6 +7,7 @@ from pathlib import Path
 import pygame
 from pygame import K_UP, K_LEFT, K_RIGHT, K_DOWN, K_SPACE, K_s
 from pygame.locals import HWSURFACE, DOUBLEBUF, RESIZABLE
+import torch as th
 import matplotlib
 matplotlib.use('TkAgg')
 from os import listdir
@@ -27,6 +30,9 @@ from overcooked_ai_py.mdp.overcooked_mdp import Direction, Action, OvercookedSta
 from overcooked_ai_py.visualization.state_visualizer import StateVisualizer
 from overcooked_ai_py.planning.planners import MediumLevelActionManager
 
+# Matches trial files (<layout_name>.<trial_id>.pickle), capturing the trial id
+TRIAL_FILE_RE = re.compile(r'^.*\.([0-9]+)\.pickle$')
+
 no_counters_params = {
     'start_orientations': False,
     'wait_allowed': False,
@@ -36,6 +42,17 @@ no_counters_params = {
     'same_motion_goals': True
 }
 
+# Action index of each playable key, any other key is a stay. Built once instead of mapping key -> action -> index
+KEY_TO_ACTION_IDX = {
+    K_UP: Action.ACTION_TO_INDEX[Direction.NORTH],
+    K_RIGHT: Action.ACTION_TO_INDEX[Direction.EAST],
+    K_DOWN: Action.ACTION_TO_INDEX[Direction.SOUTH],
+    K_LEFT: Action.ACTION_TO_INDEX[Direction.WEST],
+    K_SPACE: Action.ACTION_TO_INDEX[Action.INTERACT],
+    K_s: Action.ACTION_TO_INDEX[Action.STAY],
+}
+STAY_IDX = Action.ACTION_TO_INDEX[Action.STAY]
+
 valid_counters = [(5, 3)]
 one_counter_params = {
     'start_orientations': False,
@@ -47,23 +64,33 @@ one_counter_params = {
 }
 
 
-def str_to_actions(joint_action):
+@lru_cache(maxsize=1024)
+def _parse_joint_action(joint_action):
     """
-    Convert df cell format of a joint action to a joint action as a tuple of indices.
-    Used to convert pickle files which are stored as strings into np.arrays
+    Parses a joint action string. Cached since there are only a few distinct joint actions in a trajectory.
     """
     try:
         joint_action = json.loads(joint_action)
     except json.decoder.JSONDecodeError:
         # Hacky fix taken from https://github.com/HumanCompatibleAI/human_aware_rl/blob/master/human_aware_rl/human/data_processing_utils.py#L29
-        joint_action = eval(joint_action)
+        joint_action = ast.literal_eval(joint_action)
+    joint_action = list(joint_action)
     for i in range(2):
         if type(joint_action[i]) is list:
             joint_action[i] = tuple(joint_action[i])
         if type(joint_action[i]) is str:
             joint_action[i] = joint_action[i].lower()
         assert joint_action[i] in Action.ALL_ACTIONS
-    return joint_action
+    return tuple(joint_action)
+
+
+def str_to_actions(joint_action):
+    """
+    Convert df cell format of a joint action to a joint action as a tuple of indices.
+    Used to convert pickle files which are stored as strings into np.arrays
+    """
+    # Copy to a list so that callers can't modify the cached value
+    return list(_parse_joint_action(joint_action))
 
 
 def str_to_state(state):
@@ -117,11 +144,21 @@ class App:
         # self.env.env.reset(start_state_kwargs=ss_kwargs)
 
         self.grid_shape = self.env.grid_shape
+        # Reused across frames, creating a new visualizer every frame reloads all its sprites
+        self.visualizer = StateVisualizer()
+        self.terrain_mtx = self.env.env.mdp.terrain_mtx
         if traj_file is not None:
             self.mode = 'replay'
         elif agent is not None:
             self.mode = 'play'
             self.encoding_fn = ENCODING_SCHEMES[args.encoding_fn]
+            # Agents that take tensor observations get them through reusable buffers, see obs_to_tensors
+            self.use_tensor_obs = getattr(agent, 'tensor_obs', False)
+            self.obs_buffers = {}
+            # When the agent also plays the teammate, both players' actions are predicted in a single batched call.
+            # Only done for agents without per-episode state, since both players share one agent
+            self.batch_with_teammate = isinstance(agent, OAIAgent) and agent.supports_batched_episodes and \
+                                       not self.use_subtask_env and self.env.teammate is agent
         else:
             self.mode = 'collect_data'
         self.agent = agent
@@ -134,12 +171,17 @@ class App:
         self.data_path.mkdir(parents=True, exist_ok=True)
         self.collect_trajectory = not bool(traj_file)
         if self.collect_trajectory:
-            self.trajectory = []
-            trial_file = re.compile('^.*\.[0-9]+\.pickle$')
+            # The trajectory is stored column-wise, one row per tick. The other columns are derived when saving
+            # The env's horizon can be unbounded (a float such as 1e10), in which case the buffers grow in step_env
+            max_ticks = int(min(self.env.env.horizon, self.args.horizon))
+            self.traj_states = [None] * max_ticks
+            self.traj_joint_actions = [None] * max_ticks
+            self.traj_rewards = np.zeros(max_ticks, dtype=int)
             trial_ids = []
             for file in listdir(self.data_path):
-                if isfile(join(self.data_path, file)) and trial_file.match(file):
-                    trial_ids.append(int(file.split('.')[-2]))
+                match = TRIAL_FILE_RE.match(file)
+                if match and isfile(join(self.data_path, file)):
+                    trial_ids.append(int(match.group(1)))
             self.trial_id = max(trial_ids) + 1 if len(trial_ids) > 0 else 1
         else:
             self.trajectory = pd.read_pickle(data_path / traj_file) if traj_file else []
@@ -147,7 +189,9 @@ class App:
 
     def on_init(self):
         pygame.init()
-        surface = StateVisualizer().render_state(self.env.state, grid=self.env.env.mdp.terrain_mtx)
+        # Render with the hud so that the window is created with the size of every frame rendered by on_render.
+        # This is the only place where the window is created
+        surface = self.visualizer.render_state(self.env.state, grid=self.terrain_mtx, hud_data={"timestep": self.curr_tick})
         self.window = pygame.display.set_mode(surface.get_size(), HWSURFACE | DOUBLEBUF | RESIZABLE)
         self.window.blit(surface, (0, 0))
         pygame.display.flip()
@@ -156,60 +200,40 @@ class App:
     def on_event(self, event, pidx):
         if event.type == pygame.KEYDOWN:
             pressed_key = event.dict['key']
-            action = None
-
-            if pressed_key == K_UP:
-                action = Direction.NORTH
-            elif pressed_key == K_RIGHT:
-                action = Direction.EAST
-            elif pressed_key == K_DOWN:
-                action = Direction.SOUTH
-            elif pressed_key == K_LEFT:
-                action = Direction.WEST
-            elif pressed_key == K_SPACE:
-                action = Action.INTERACT
-            elif pressed_key == K_s:
-                action = Action.STAY
-            else:
-                action = Action.STAY
-            self.joint_action[pidx] = Action.ACTION_TO_INDEX[action]
+            self.joint_action[pidx] = KEY_TO_ACTION_IDX.get(pressed_key, STAY_IDX)
 
         if event.type == pygame.QUIT:
             self._running = False
 
-    def step_env(self, joint_action):
+    def step_env(self, joint_action, tm_action=None):
         prev_state = self.env.state
 
         if self.use_subtask_env:
             obs, reward, done, info = self.env.step(joint_action[self.p_idx])
         else:
-            obs, reward, done, info = self.env.step(joint_action)
+            # Only OvercookedGymEnv.step takes a precomputed teammate action, subclasses' step don't
+            step_kwargs = {'tm_action': tm_action} if tm_action is not None else {}
+            obs, reward, done, info = self.env.step(joint_action, **step_kwargs)
         new_state = self.env.state
         # prev_state, joint_action, info = super(OvercookedPsiturk, self).apply_actions()
 
         # Log data to send to psiturk client
         curr_reward = sum(info['sparse_r_by_agent'])
         self.score += curr_reward
-        transition = {
-            "state" : json.dumps(prev_state.to_dict()),
-            "joint_action" : joint_action,#json.dumps(joint_action.item()),
-            "reward" : curr_reward,
-            "time_left" : max((1200 - self.curr_tick) / self.fps, 0),
-            "score" : self.score,
-            "time_elapsed" : self.curr_tick / self.fps,
-            "cur_gameloop" : self.curr_tick,
-            "layout" : self.env.env.mdp.terrain_mtx,
-            "layout_name" : self.layout_name,
-            "trial_id" : 100 # TODO this is just for testing self.trial_id,
-            # "player_0_id" : self.agents[0],
-            # "player_1_id" : self.agents[1],
-            # "player_0_is_human" : self.agents[0] in self.human_players,
-            # "player_1_is_human" : self.agents[1] in self.human_players
-        }
         if self.collect_trajectory:
-            self.trajectory.append(transition)
+            if self.curr_tick >= len(self.traj_rewards):
+                self.grow_trajectory_buffers()
+            self.traj_states[self.curr_tick] = json.dumps(prev_state.to_dict())
+            self.traj_joint_actions[self.curr_tick] = joint_action #json.dumps(joint_action.item()),
+            self.traj_rewards[self.curr_tick] = curr_reward
         return done
 
+    def grow_trajectory_buffers(self):
+        n = max(len(self.traj_rewards), 1)
+        self.traj_states.extend([None] * n)
+        self.traj_joint_actions.extend([None] * n)
+        self.traj_rewards = np.concatenate([self.traj_rewards, np.zeros(n, dtype=int)])
+
     def on_loop(self):
         assert(all([action is not None for action in self.joint_action]))
         done = self.step_env(self.joint_action)
@@ -221,14 +245,34 @@ class App:
 
     def on_render(self, pidx=None):
         p0_action = Action.ACTION_TO_INDEX[self.joint_action[0]] if pidx == 1 else None
-        surface = StateVisualizer().render_state(self.env.state, grid=self.env.env.mdp.terrain_mtx, pidx=pidx, hud_data={"timestep": self.curr_tick}, p0_action=p0_action)
-        self.window = pygame.display.set_mode(surface.get_size(), HWSURFACE | DOUBLEBUF | RESIZABLE)
+        surface = self.visualizer.render_state(self.env.state, grid=self.terrain_mtx, pidx=pidx, hud_data={"timestep": self.curr_tick}, p0_action=p0_action)
         self.window.blit(surface, (0, 0))
-        pygame.display.flip()
+        pygame.display.update(surface.get_rect())
         # save = input('press y to save')
         # if save.lower() == 'y':
         #     pygame.image.save(self.window, "screenshot.png")
 
+    def obs_to_tensors(self, obs):
+        """
+        Converts obs to tensors on args.device for the agent. When using cuda, observations are copied into persistent
+        pinned host buffers and then asynchronously into persistent device buffers, so no memory is allocated per tick.
+        """
+        obs_t = {}
+        for k, v in obs.items():
+            if k not in self.agent.policy.observation_space.keys():
+                continue
+            src = th.from_numpy(np.ascontiguousarray(v))
+            if self.args.device.type != 'cuda':
+                obs_t[k] = src
+                continue
+            if k not in self.obs_buffers:
+                self.obs_buffers[k] = (th.empty(src.shape, dtype=src.dtype, pin_memory=True),
+                                       th.empty(src.shape, dtype=src.dtype, device=self.args.device))
+            host_buffer, device_buffer = self.obs_buffers[k]
+            host_buffer.copy_(src)
+            obs_t[k] = device_buffer.copy_(host_buffer, non_blocking=True)
+        return obs_t
+
     def on_cleanup(self):
         pygame.quit()
 
@@ -237,8 +281,9 @@ class App:
             self._running = False
         while (self._running):
             self.joint_action = [None, None]
+            # State only changes in on_loop, so a single render per tick is enough for both players
+            self.on_render()
             for i in range(2):
-                self.on_render() #pidx=i)
                 while self.joint_action[i] is None:
                     for event in pygame.event.get():
                         self.on_event(event, i)
@@ -254,18 +299,21 @@ class App:
         if self.on_init() == False:
             self._running = False
         sleep_time = 1000 // self.fps
-        trial_id = self.trajectory.iloc[0]['trial_id']
-        for index, row in self.trajectory.iterrows():
-            if row['trial_id'] == trial_id and not self.env.is_done():
+        # Extract the columns once instead of building a row Series for every step
+        joint_actions = self.trajectory['joint_action'].to_numpy()
+        trial_ids = self.trajectory['trial_id'].to_numpy()
+        trial_id = trial_ids[0]
+        for i in range(len(trial_ids)):
+            if trial_ids[i] == trial_id and not self.env.is_done():
                 self.on_render()
-                # assert str_to_state(row['state']) == self.env.state
+                # assert str_to_state(self.trajectory['state'].iloc[i]) == self.env.state
                 pygame.time.wait(sleep_time)
-                self.joint_action = str_to_actions(row['joint_action'])
+                self.joint_action = str_to_actions(joint_actions[i])
                 self.on_loop()
             else:
                 self.env.reset()
                 print(f'Trial finished in {self.curr_tick} steps with total reward {self.score}')
-                trial_id = row['trial_id']
+                trial_id = trial_ids[i]
                 self.score = 0
                 self.curr_tick = 0
         self.on_cleanup()
@@ -290,8 +338,16 @@ class App:
             #     else:
             obs = self.env.get_obs(self.env.p_idx, on_reset=on_reset)
             on_reset = False
+            tm_action = None
+            if self.batch_with_teammate:
+                tm_obs = self.env.get_obs(self.env.t_idx, enc_fn=self.agent.encoding_fn)
+                obs = {k: np.stack([obs[k], tm_obs[k]]) for k in self.agent.policy.observation_space.keys()}
+            if self.use_tensor_obs:
+                obs = self.obs_to_tensors(obs)
             # if type(self.agent) == HumanManagerHRL:
             self.agent_action = self.agent.predict(obs, state=self.env.state)[0]#.squeeze()#.detach().item()
+            if self.batch_with_teammate:
+                self.agent_action, tm_action = self.agent_action
                     # else:
                     #     obs.pop('player_completed_subtasks')
                     #     obs.pop('teammate_completed_subtasks')
@@ -299,7 +355,7 @@ class App:
             pygame.time.wait(sleep_time)
             self.on_render()
 
-            done = self.step_env(self.agent_action)
+            done = self.step_env(self.agent_action, tm_action)
             self.curr_tick += 1
 
             if done:
@@ -320,21 +376,37 @@ class App:
             self.play_execution()
 
     def save_trajectory(self):
-        df = pd.DataFrame(self.trajectory)
+        n = self.curr_tick
+        ticks = np.arange(n)
+        rewards = self.traj_rewards[:n]
+        df = pd.DataFrame({
+            "state" : self.traj_states[:n],
+            "joint_action" : self.traj_joint_actions[:n],
+            "reward" : rewards,
+            "time_left" : np.maximum((1200 - ticks) / self.fps, 0),
+            "score" : np.cumsum(rewards),
+            "time_elapsed" : ticks / self.fps,
+            "cur_gameloop" : ticks,
+            "layout" : [self.terrain_mtx] * n,
+            "layout_name" : self.layout_name,
+            "trial_id" : 100 # TODO this is just for testing self.trial_id,
+            # "player_0_id" : self.agents[0],
+            # "player_1_id" : self.agents[1],
+            # "player_0_is_human" : self.agents[0] in self.human_players,
+            # "player_1_is_human" : self.agents[1] in self.human_players
+        })
         df.to_pickle(self.data_path / f'{self.layout_name}.{self.trial_id}.pickle')
 
     @staticmethod
     def combine_df(data_path):
-        trial_file = re.compile('^.*\.[0-9]+\.pickle$')
-        df = pd.concat([pd.read_pickle(data_path / f) for f in listdir(data_path) if trial_file.match(f)])
+        df = pd.concat([pd.read_pickle(data_path / f) for f in listdir(data_path) if TRIAL_FILE_RE.match(f)])
         print(f'Combined df has a length of {len(df)}')
         df.to_pickle(data_path / f'all_trials.pickle')
 
     @staticmethod
     def fix_files_df(data_path):
-        trial_file = re.compile('^.*\.[0-9]+\.pickle$')
         for f in listdir(data_path):
-            if trial_file.match(f):
+            if TRIAL_FILE_RE.match(f):
                 df = pd.read_pickle(data_path / f)
                 def joiner(list_of_lists):
                     for i in range(len(list_of_lists)):
@@ -356,6 +428,7 @@ class HumanManagerHRL(OAIAgent):
         self.curr_subtask_id = 11
         self.prev_pcs = None
 
+    @th.inference_mode()
     def get_distribution(self, obs, sample=True):
         if obs['player_completed_subtasks'] is not None:
             # Completed previous subtask, set new subtask
@@ -365,6 +438,7 @@ class HumanManagerHRL(OAIAgent):
         obs['curr_subtask'] = self.curr_subtask_id
         return self.worker.get_distribution(obs, sample=sample)
 
+    @th.inference_mode()
     def predict(self, obs, state=None, episode_start=None, deterministic: bool=False):
         print(obs['player_completed_subtasks'])
         if np.sum(obs['player_completed_subtasks']) == 1:
@@ -0,0 +1,67 @@
+import pytest
+import numpy as np
+from oai_agents.agents.agent_utils import DummyAgent
+from oai_agents.agents.base_agent import _batched_eval, OAIAgent, SB3Wrapper, SB3LSTMWrapper, PolicyClone
+
+
+class FakeVecEnv:
+    # Env i gets a reward of 1 per step and its episodes last episode_lengths[i] steps
+    def __init__(self, episode_lengths):
+        self.episode_lengths = np.array(episode_lengths)
+        self.num_envs = len(episode_lengths)
+        self.steps = np.zeros(self.num_envs, dtype=int)
+        self.n_renders = 0
+
+    def reset(self):
+        self.steps[:] = 0
+        return {'visual_obs': np.zeros((self.num_envs, 1))}
+
+    def step_async(self, actions):
+        assert len(actions) == self.num_envs
+
+    def step_wait(self):
+        self.steps += 1
+        dones = self.steps == self.episode_lengths
+        self.steps[dones] = 0
+        return {'visual_obs': np.zeros((self.num_envs, 1))}, np.ones(self.num_envs), dones, [{}] * self.num_envs
+
+    def env_method(self, method_name, *args, indices=None, **kwargs):
+        assert method_name == 'render'
+        self.n_renders += 1
+
+
+class FakeAgent:
+    tensor_obs = False
+
+    def predict(self, obs, state=None, episode_start=None, deterministic=False):
+        return np.zeros(len(obs['visual_obs']), dtype=int), None
+
+
+@pytest.mark.parametrize('episode_lengths,n_episodes,expected_returns', [
+    ([2, 3], 5, [2, 2, 3, 3, 3]),
+    ([2, 3], 4, [2, 2, 3, 3]),
+    ([4], 3, [4, 4, 4]),
+    ([1, 2, 5], 4, [1, 2, 5, 5]),
+])
+def test_batched_eval_returns(episode_lengths, n_episodes, expected_returns):
+    mean, std = _batched_eval(FakeVecEnv(episode_lengths), FakeAgent(), n_episodes)
+    assert mean == pytest.approx(np.mean(expected_returns))
+    assert std == pytest.approx(np.std(expected_returns))
+
+
+def test_batched_eval_render():
+    env = FakeVecEnv([2, 3])
+    _batched_eval(env, FakeAgent(), 2, render=True)
+    # Stops as soon as both envs finished their episode
+    assert env.n_renders == 3
+
+
+@pytest.mark.parametrize('agent_cls,expected', [
+    (OAIAgent, False),
+    (SB3Wrapper, True),
+    (SB3LSTMWrapper, False),
+    (PolicyClone, True),
+    (DummyAgent, True),
+])
+def test_supports_batched_episodes(agent_cls, expected):
+    assert agent_cls.supports_batched_episodes == expected
@@ -0,0 +1,30 @@
+import sys
+from pathlib import Path
+import pytest
+sys.path.append(str(Path(__file__).parent.parent / 'scripts'))
+from run_overcooked_game import str_to_actions, _parse_joint_action
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    _parse_joint_action.cache_clear()
+
+
+@pytest.mark.parametrize('joint_action', [
+    '[[0, -1], "INTERACT"]',  # json
+    "[(0, -1), 'interact']",  # python literal
+])
+def test_str_to_actions(joint_action):
+    assert str_to_actions(joint_action) == [(0, -1), 'interact']
+
+
+def test_str_to_actions_stay():
+    assert str_to_actions('[[0, 0], [1, 0]]') == [(0, 0), (1, 0)]
+
+
+def test_str_to_actions_returns_copy():
+    joint_action = '[[0, -1], "INTERACT"]'
+    actions = str_to_actions(joint_action)
+    actions[0] = 'modified'
+    assert str_to_actions(joint_action) == [(0, -1), 'interact']
+    assert _parse_joint_action.cache_info().hits == 1